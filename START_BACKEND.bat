@@ -44,6 +44,6 @@ echo.
 echo Press Ctrl+C to stop the server
 echo.
 
-python main.py
+python main.py %*
 
 pause
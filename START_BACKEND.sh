@@ -43,4 +43,4 @@ echo
 echo "Press Ctrl+C to stop the server"
 echo
 
-python3 main.py
+python3 main.py "$@"
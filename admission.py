@@ -0,0 +1,277 @@
+"""
+admission.py
+========================================
+Admission Control for Imaging Jobs
+Header-based cost estimates, memory budget and backpressure
+========================================
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# =========================================================
+# CONFIGURATION (override with environment variables)
+# =========================================================
+MEMORY_BUDGET_MB = int(os.environ.get("CARDIO_MEMORY_BUDGET_MB", "2048"))  # whole server
+MAX_CONCURRENT_JOBS = int(os.environ.get("CARDIO_MAX_CONCURRENT_JOBS", "2"))
+MAX_QUEUED_JOBS = int(os.environ.get("CARDIO_MAX_QUEUED_JOBS", "8"))
+MAX_QUEUE_WAIT_S = float(os.environ.get("CARDIO_MAX_QUEUE_WAIT_S", "30"))
+
+ADMISSION_PUBLISH_S = float(os.environ.get("CARDIO_ADMISSION_PUBLISH_S", "2"))  # worker snapshot interval
+
+FLOAT_BYTES = 8  # get_fdata() / load_frame() produce float64
+RENDER_OVERHEAD_BYTES = 64 * 1024 * 1024  # matplotlib figures + PNG buffers
+
+class AdmissionRejected(Exception):
+    """Raised when a job cannot be admitted (overload or too large)."""
+
+    def __init__(self, reason: str, retry_after: int = None, status_code: int = 429):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+def estimate_job_cost(nifti_path: str):
+    """
+    Estimate the memory and CPU cost of analyzing a NIfTI file.
+
+    Only the header is read: shape, on-disk dtype and dimension count.
+    A job holds one frame as raw data plus its float64 copy, and 4D cine
+    scans are read one timepoint at a time.
+
+    Args:
+        nifti_path: Path to NIfTI file (.nii or .nii.gz)
+
+    Returns:
+        dict: shape, dtype, ndim, memory_bytes, cpu_mvoxels
+    """
+    import nibabel as nib
+
+    try:
+        img = nib.load(nifti_path)
+    except Exception as e:
+        raise ValueError(f"Invalid NIfTI file: {str(e)}")
+
+    shape = tuple(int(n) for n in img.shape)
+    dtype = img.header.get_data_dtype()
+
+    frame_voxels = math.prod(shape[:3])
+    memory_bytes = frame_voxels * (dtype.itemsize + FLOAT_BYTES) + RENDER_OVERHEAD_BYTES
+
+    return {
+        "shape": list(shape),
+        "dtype": str(dtype),
+        "ndim": len(shape),
+        "memory_bytes": memory_bytes,
+        "cpu_mvoxels": frame_voxels / 1e6,
+    }
+
+class AdmissionController:
+    """
+    Admits imaging jobs against a memory budget and a concurrency limit.
+
+    Jobs that don't fit, or arrive while others are already waiting, join
+    a bounded first-in, first-out queue for up to ``max_wait_s``; only the
+    head of the queue is admitted when capacity frees up, so a steady
+    stream of small jobs cannot starve a large one.
+    A full queue or an expired wait raises AdmissionRejected (429) with a
+    Retry-After estimate; a job larger than the whole budget is rejected
+    outright (413).
+    """
+
+    def __init__(
+        self,
+        memory_budget_bytes: int = None,
+        max_concurrent: int = MAX_CONCURRENT_JOBS,
+        max_queued: int = MAX_QUEUED_JOBS,
+        max_wait_s: float = MAX_QUEUE_WAIT_S,
+    ):
+        if memory_budget_bytes is None:
+            # Each worker process gets an equal share of the server budget
+            workers = max(1, int(os.environ.get("CARDIO_WORKERS", "1")))
+            memory_budget_bytes = MEMORY_BUDGET_MB * 1024 * 1024 // workers
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait_s = max_wait_s
+
+        self._cond = asyncio.Condition()
+        self.in_flight = 0
+        self.memory_in_use = 0
+        self._waiters = deque()  # queued jobs, oldest first
+
+        # Monitoring
+        self.counters = {"admitted": 0, "admitted_after_wait": 0, "rejected_queue_full": 0,
+                         "rejected_timeout": 0, "rejected_too_large": 0}
+        self._wait_times = deque(maxlen=500)
+        self._decisions = deque(maxlen=50)
+        self._avg_job_s = 10.0  # EWMA of job duration, seeds Retry-After
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _fits(self, memory_bytes: int) -> bool:
+        return (
+            self.in_flight < self.max_concurrent
+            and self.memory_in_use + memory_bytes <= self.memory_budget_bytes
+        )
+
+    def _retry_after(self) -> int:
+        backlog = self.in_flight + self.queued
+        return max(1, math.ceil(self._avg_job_s * backlog / self.max_concurrent))
+
+    def _record(self, decision: str, cost: dict, wait_s: float):
+        self._decisions.append({
+            "time": time.time(),
+            "decision": decision,
+            "shape": cost["shape"],
+            "memory_mb": round(cost["memory_bytes"] / 1024 / 1024, 1),
+            "wait_ms": round(wait_s * 1000, 1),
+        })
+
+    def _reject(self, counter: str, cost: dict, wait_s: float, reason: str, status_code: int = 429):
+        self.counters[counter] += 1
+        self._record(counter, cost, wait_s)
+        retry_after = self._retry_after() if status_code == 429 else None
+        print(f"🚦 Rejected job {cost['shape']}: {reason}")
+        raise AdmissionRejected(reason, retry_after, status_code)
+
+    @asynccontextmanager
+    async def admit(self, cost: dict):
+        """
+        Hold a slot and the job's memory reservation for the duration of
+        the ``async with`` block.
+        """
+        memory_bytes = cost["memory_bytes"]
+        start = time.monotonic()
+
+        async with self._cond:
+            if memory_bytes > self.memory_budget_bytes:
+                self._reject(
+                    "rejected_too_large", cost, 0.0,
+                    f"Scan needs ~{memory_bytes // 1024 // 1024} MB, "
+                    f"over the {self.memory_budget_bytes // 1024 // 1024} MB budget",
+                    status_code=413,
+                )
+
+            # Admit straight away only if nobody is ahead in the queue
+            if self._waiters or not self._fits(memory_bytes):
+                if self.queued >= self.max_queued:
+                    self._reject("rejected_queue_full", cost, 0.0, "Server busy: analysis queue is full")
+
+                waiter = object()
+                self._waiters.append(waiter)
+                try:
+                    await asyncio.wait_for(
+                        self._cond.wait_for(
+                            lambda: self._waiters[0] is waiter and self._fits(memory_bytes)
+                        ),
+                        timeout=self.max_wait_s,
+                    )
+                except asyncio.TimeoutError:
+                    self._reject(
+                        "rejected_timeout", cost, time.monotonic() - start,
+                        f"Server busy: no capacity within {self.max_wait_s:.0f}s",
+                    )
+                finally:
+                    # Admitted or gone: the next job in line may fit now
+                    self._waiters.remove(waiter)
+                    self._cond.notify_all()
+
+            wait_s = time.monotonic() - start
+            self.in_flight += 1
+            self.memory_in_use += memory_bytes
+            self.counters["admitted"] += 1
+            if wait_s > 0.001:
+                self.counters["admitted_after_wait"] += 1
+            self._wait_times.append(wait_s)
+            self._record("admitted", cost, wait_s)
+
+        print(f"🚦 Admitted job {cost['shape']} (~{memory_bytes // 1024 // 1024} MB, waited {wait_s:.2f}s)")
+        job_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_job_s = 0.8 * self._avg_job_s + 0.2 * (time.monotonic() - job_start)
+            async with self._cond:
+                self.in_flight -= 1
+                self.memory_in_use -= memory_bytes
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Snapshot of this worker's load, counters and queue wait times."""
+        return {
+            "pid": os.getpid(),
+            "config": {
+                "memory_budget_mb": self.memory_budget_bytes // 1024 // 1024,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "max_wait_s": self.max_wait_s,
+            },
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "memory_in_use_mb": round(self.memory_in_use / 1024 / 1024, 1),
+            "counters": dict(self.counters),
+            "queue_wait_ms": wait_percentiles(self._wait_times),
+            "avg_job_s": round(self._avg_job_s, 2),
+            "recent_decisions": list(self._decisions),
+        }
+
+    def snapshot(self) -> dict:
+        """stats() plus the raw wait times, for merging across workers."""
+        return dict(self.stats(), published_at=time.time(), wait_times=list(self._wait_times))
+
+def wait_percentiles(wait_times) -> dict:
+    """p50/p95/max of queue wait times (seconds), in ms."""
+    waits = sorted(wait_times)
+
+    def pct(p):
+        if not waits:
+            return 0.0
+        return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 1)
+
+    return {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)}
+
+def merge_stats(snapshots: list) -> dict:
+    """
+    Server-wide admission stats from every worker's snapshot: budgets,
+    load and counters are summed, wait percentiles recomputed over all
+    workers' waits, and each worker's own stats listed under "workers".
+    """
+    snapshots = sorted(snapshots, key=lambda snap: snap["pid"])
+    workers = [
+        {k: v for k, v in snap.items() if k not in ("wait_times", "recent_decisions")}
+        for snap in snapshots
+    ]
+
+    def total(get):
+        return sum(get(snap) for snap in snapshots)
+
+    decisions = sorted(
+        (dict(decision, pid=snap["pid"]) for snap in snapshots for decision in snap["recent_decisions"]),
+        key=lambda decision: decision["time"],
+    )
+    return {
+        "workers": workers,
+        "config": {
+            "memory_budget_mb": total(lambda snap: snap["config"]["memory_budget_mb"]),
+            "max_concurrent": total(lambda snap: snap["config"]["max_concurrent"]),
+            "max_queued": total(lambda snap: snap["config"]["max_queued"]),
+            "max_wait_s": max((snap["config"]["max_wait_s"] for snap in snapshots), default=MAX_QUEUE_WAIT_S),
+        },
+        "in_flight": total(lambda snap: snap["in_flight"]),
+        "queued": total(lambda snap: snap["queued"]),
+        "memory_in_use_mb": round(total(lambda snap: snap["memory_in_use_mb"]), 1),
+        "counters": {
+            name: total(lambda snap: snap["counters"].get(name, 0))
+            for name in (snapshots[0]["counters"] if snapshots else ())
+        },
+        "queue_wait_ms": wait_percentiles([w for snap in snapshots for w in snap["wait_times"]]),
+        "avg_job_s": round(total(lambda snap: snap["avg_job_s"]) / len(snapshots), 2) if snapshots else 0.0,
+        "recent_decisions": decisions[-50:],
+    }
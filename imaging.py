@@ -12,41 +12,50 @@ import numpy as np
 import os
 import base64
 import io
+import threading
+from collections import OrderedDict
 import matplotlib
 matplotlib.use('Agg')  # Non-GUI backend
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure  # OO API: safe to render from worker threads
 from matplotlib import cm
+import matplotlib.image as mpimg
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-SLICE_DIR = os.path.join(BASE_DIR, "slices")
-os.makedirs(SLICE_DIR, exist_ok=True)
+from intensity import apply_window, resolve_window
+from shared_cache import get_shared_cache
 
-def process_nifti(nifti_path: str):
-    """
-    Load a NIfTI file, generate center slices WITH HEART SEGMENTATION,
-    and compute measurements. Returns base64-encoded images with red heart overlay.
+# Axis of the (x, y, z) volume that each viewing plane cuts through
+PLANE_AXES = {"sagittal": 0, "coronal": 1, "axial": 2}
 
-    Args:
-        nifti_path: Path to NIfTI file (.nii or .nii.gz)
+# Milliseconds per NIfTI time unit (xyzt_units); "unknown" is taken as ms
+TIME_UNIT_MS = {"sec": 1000.0, "msec": 1.0, "usec": 0.001}
+
+# Rendered cine frames, keyed by (file, plane, index, timepoint, window,
+# mask range).
+# Kept in memory per worker and on disk in the shared cache.
+CINE_CACHE_SIZE = 512
+_cine_cache = OrderedDict()
+_cine_lock = threading.Lock()
+
+def read_header(nifti_path: str):
+    """
+    Read shape and spacing from the NIfTI header (no voxel data).
 
     Returns:
-        tuple: (meta, resolution, measurements, slices_data, sliders)
+        dict: shape, spacing (mm, x/y/z) and frame_interval_ms (4D only)
     """
     try:
         print(f"📂 Loading NIfTI file: {nifti_path}")
         img = nib.load(nifti_path)
-        data = img.get_fdata()
-        print(f"✅ Loaded successfully")
+        print(f"✅ Loaded header successfully")
     except Exception as e:
         raise ValueError(f"Invalid NIfTI file: {str(e)}")
 
-    # Enforce 3D volume
-    if data.ndim < 3:
+    # Enforce 3D volume or 4D cine (x, y, z, t), checked from the header only
+    shape = tuple(int(n) for n in img.shape)
+    if len(shape) < 3:
         raise ValueError("Uploaded scan is not a 3D volume")
-
-    # Ensure NumPy array
-    data = np.asarray(data)
-    shape = data.shape
+    if len(shape) > 4:
+        raise ValueError(f"Unsupported {len(shape)}D scan (expected 3D volume or 4D cine)")
     print(f"📊 Shape: {shape}")
 
     # Spacing (voxel dimensions)
@@ -57,60 +66,86 @@ def process_nifti(nifti_path: str):
         spacing = (1.0, 1.0, 1.0)
     print(f"📏 Spacing: {spacing} mm")
 
-    # =========================================================
-    # EXTRACT CENTER SLICES
-    # =========================================================
+    # The fourth zoom is in the header's time unit; report it in ms
+    frame_interval_ms = None
+    if len(shape) == 4 and len(raw_spacing) >= 4:
+        time_unit = img.header.get_xyzt_units()[1]
+        frame_interval_ms = float(raw_spacing[3]) * TIME_UNIT_MS.get(time_unit, 1.0)
+        print(f"⏱️  Frame interval: {frame_interval_ms:.1f} ms ({float(raw_spacing[3]):g} {time_unit})")
 
+    return {"shape": shape, "spacing": spacing, "frame_interval_ms": frame_interval_ms}
+
+def load_center_slices(nifti_path: str, header: dict):
+    """
+    Read the volume (first timepoint for 4D cine) and extract the center
+    axial, coronal and sagittal slices.
+
+    Returns:
+        dict: plane -> 2D numpy array
+    """
+    # For cine data only the first timepoint is read; other frames are
+    # pulled lazily through the array proxy when requested.
+    try:
+        data = load_frame(nib.load(nifti_path), 0)
+    except Exception as e:
+        raise ValueError(f"Invalid NIfTI file: {str(e)}")
+
+    shape = header["shape"]
     axial_idx = shape[2] // 2
     coronal_idx = shape[1] // 2
     sagittal_idx = shape[0] // 2
 
-    axial_slice = data[:, :, axial_idx]
-    coronal_slice = data[:, coronal_idx, :]
-    sagittal_slice = data[sagittal_idx, :, :]
+    # Copy so the full volume can be freed once this returns
+    slices = {
+        "axial": data[:, :, axial_idx].copy(),
+        "coronal": data[:, coronal_idx, :].copy(),
+        "sagittal": data[sagittal_idx, :, :].copy(),
+    }
 
     print(f"🔪 Extracted slices - Axial: {axial_idx}, Coronal: {coronal_idx}, Sagittal: {sagittal_idx}")
+    return slices
 
-    # =========================================================
-    # CREATE HEART SEGMENTATION MASK AND APPLY RED OVERLAY
-    # =========================================================
-
-    print("🫀 Generating heart segmentation with red overlay...")
-
-    # Create segmentation masks (simulate heart detection)
-    axial_mask = create_heart_mask(axial_slice)
-    coronal_mask = create_heart_mask(coronal_slice)
-    sagittal_mask = create_heart_mask(sagittal_slice)
+def segment_slices(slices: dict, stats: dict = None):
+    """
+    Create heart segmentation masks (simulated detection) for each slice.
+    With volume statistics, slices are normalized against the volume's
+    1st-99th percentiles instead of their own min/max.
 
-    # Convert to base64 images with red overlay
-    axial_b64 = slice_to_base64_with_overlay(axial_slice, axial_mask, "axial")
-    coronal_b64 = slice_to_base64_with_overlay(coronal_slice, coronal_mask, "coronal")
-    sagittal_b64 = slice_to_base64_with_overlay(sagittal_slice, sagittal_mask, "sagittal")
+    Returns:
+        dict: plane -> 2D boolean mask
+    """
+    print("🫀 Generating heart segmentation...")
+    value_range = mask_range(stats) if stats else None
+    return {plane: create_heart_mask(slice_data, value_range) for plane, slice_data in slices.items()}
 
-    # =========================================================
-    # METADATA
-    # =========================================================
+def render_slices(slices: dict, masks: dict, stats: dict = None):
+    """
+    Render each slice as a plain grayscale PNG and encode its mask, for
+    compositing the overlay in the browser. With volume statistics the
+    slices use the "auto" window (1st-99th percentile).
 
-    meta = {
-        "anatomical_area": "Heart / Cardiovascular",
-        "categories": "CT Scan, Cardiology",
-        "data_volume": f"{shape[0]} × {shape[1]} × {shape[2]}",
-        "file_format": "NIfTI (.nii.gz)"
+    Returns:
+        dict: "slices" (plane -> base64 PNG data URL) and
+        "masks" (plane -> run-length-encoded mask payload)
+    """
+    bounds = resolve_window(stats, "auto") if stats else None
+    return {
+        "slices": {
+            plane: slice_to_base64_gray(slice_data, stats, bounds)
+            for plane, slice_data in slices.items()
+        },
+        "masks": {plane: mask_payload(mask) for plane, mask in masks.items()},
     }
 
-    # =========================================================
-    # RESOLUTION
-    # =========================================================
-
-    resolution = {
-        "spacing_mm": f"{spacing[0]:.2f} × {spacing[1]:.2f} × {spacing[2]:.2f}",
-        "image_size": f"{shape[0]} × {shape[1]} × {shape[2]}",
-        "num_slices": str(shape[2])
-    }
+def compute_measurements(header: dict):
+    """
+    Estimate heart dimensions from the scan extent and voxel spacing.
 
-    # =========================================================
-    # MEASUREMENTS (Estimate heart dimensions)
-    # =========================================================
+    Returns:
+        dict: length, width, depth, volume, weight (formatted strings)
+    """
+    shape = header["shape"]
+    spacing = header["spacing"]
 
     # Calculate physical dimensions
     length_mm = shape[0] * spacing[0]
@@ -137,35 +172,81 @@ def process_nifti(nifti_path: str):
     }
 
     print(f"📐 Measurements: {measurements}")
+    return measurements
+
+def describe_scan(header: dict):
+    """
+    Build the metadata, resolution and slider configuration for a scan.
+
+    Returns:
+        tuple: (meta, resolution, sliders)
+    """
+    shape = header["shape"]
+    spacing = header["spacing"]
+    is_cine = len(shape) == 4
+    num_frames = shape[3] if is_cine else 1
 
     # =========================================================
-    # SLICES DATA
+    # METADATA
     # =========================================================
 
-    slices_data = {
-        "axial": axial_b64,
-        "coronal": coronal_b64,
-        "sagittal": sagittal_b64
+    meta = {
+        "anatomical_area": "Heart / Cardiovascular",
+        "categories": "CT Scan, Cardiology",
+        "data_volume": f"{shape[0]} × {shape[1]} × {shape[2]}",
+        "file_format": "NIfTI (.nii.gz)"
     }
+    if is_cine:
+        meta["categories"] = "Cine MRI, Cardiology"
+        meta["data_volume"] += f" × {num_frames} frames"
+
+    # =========================================================
+    # RESOLUTION
+    # =========================================================
+
+    resolution = {
+        "spacing_mm": f"{spacing[0]:.2f} × {spacing[1]:.2f} × {spacing[2]:.2f}",
+        "image_size": f"{shape[0]} × {shape[1]} × {shape[2]}",
+        "num_slices": str(shape[2])
+    }
+    if is_cine:
+        resolution["num_frames"] = str(num_frames)
+        if header["frame_interval_ms"] is not None:
+            resolution["frame_interval_ms"] = f"{header['frame_interval_ms']:.1f}"
 
     # =========================================================
     # SLIDERS CONFIGURATION
     # =========================================================
 
     sliders = {
-        "axial": {"min": 0, "max": shape[2] - 1, "value": axial_idx},
-        "coronal": {"min": 0, "max": shape[1] - 1, "value": coronal_idx},
-        "sagittal": {"min": 0, "max": shape[0] - 1, "value": sagittal_idx}
+        "axial": {"min": 0, "max": shape[2] - 1, "value": shape[2] // 2},
+        "coronal": {"min": 0, "max": shape[1] - 1, "value": shape[1] // 2},
+        "sagittal": {"min": 0, "max": shape[0] - 1, "value": shape[0] // 2}
     }
+    if is_cine:
+        sliders["time"] = {"min": 0, "max": num_frames - 1, "value": 0}
+
+    return meta, resolution, sliders
 
-    return meta, resolution, measurements, slices_data, sliders
+def mask_range(stats: dict):
+    """
+    Segmentation normalization range: the volume's 1st-99th percentiles
+    (the "auto" window), so a few outlier voxels can't shift the thresholds.
+    """
+    return resolve_window(stats, "auto")
 
-def create_heart_mask(slice_data):
+def create_heart_mask(slice_data, value_range=None):
     """
     Create a binary mask highlighting the heart region.
+
+    ``value_range`` (low, high) normalizes against precomputed volume
+    statistics; without it the slice's own min/max are used.
     """
     # Normalize data
-    normalized = (slice_data - np.min(slice_data)) / (np.max(slice_data) - np.min(slice_data) + 1e-8)
+    if value_range is None:
+        value_range = (np.min(slice_data), np.max(slice_data))
+    low, high = value_range
+    normalized = (slice_data - low) / (high - low + 1e-8)
 
     # Create mask based on intensity threshold
     threshold_low = 0.3
@@ -193,35 +274,273 @@ def create_heart_shape_mask(shape):
 
     return mask
 
-def slice_to_base64_with_overlay(slice_data, mask, name: str) -> str:
+# =========================================================
+# MASK ENCODING (CLIENT-SIDE OVERLAY)
+# =========================================================
+#
+# Masks and grayscale slices are served in display orientation: the same
+# picture as imshow(slice.T, origin='lower'), stored row-major from the
+# top row down. Volume masks are stacks of axial slices.
+#
+# "rle":     run lengths as unsigned LEB128 varints (7 bits per byte, low
+#            group first, high bit set on all but the last byte),
+#            alternating background / heart, always starting with a
+#            (possibly empty) background run
+# "bitpack": one bit per pixel, most significant bit first (np.packbits)
+#
+# "rle" falls back to "bitpack" whenever that is smaller (speckled masks),
+# so clients must honour the encoding returned with the data.
+
+MASK_ENCODINGS = ("rle", "bitpack")
+
+def to_display(array):
+    """Reorient a 2D slice to display orientation (top row first)."""
+    return np.flipud(array.T)
+
+def _varints(values) -> bytes:
+    """Encode non-negative integers as unsigned LEB128 varints."""
+    values = values.astype(np.uint64)
+    nbytes = np.ones(values.size, dtype=np.intp)
+    rest = values >> 7
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= 7
+
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    for k in range(int(nbytes.max(initial=0))):
+        sel = nbytes > k
+        group = (values[sel] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        group |= np.where(nbytes[sel] > k + 1, np.uint64(0x80), np.uint64(0))
+        out[starts[sel] + k] = group
+    return out.tobytes()
+
+def encode_mask(mask, encoding: str = "rle"):
     """
-    Normalize a 2D slice, apply RED heart segmentation overlay using matplotlib.
+    Encode a boolean mask (any shape, C order) as compact binary.
 
     Args:
-        slice_data: 2D numpy array
-        mask: 2D boolean array (heart segmentation)
-        name: Name for saved file (e.g., "axial")
+        mask: Boolean numpy array
+        encoding: "rle" or "bitpack"
 
     Returns:
-        str: Base64 data URL (data:image/png;base64,...)
+        tuple: (encoding actually used, bytes) - "rle" becomes "bitpack"
+        when run-length coding would be larger
     """
-    # Handle NaN/inf values
-    slice_data = np.nan_to_num(slice_data)
+    if encoding not in MASK_ENCODINGS:
+        raise ValueError(f"Unknown mask encoding '{encoding}' (expected one of {', '.join(MASK_ENCODINGS)})")
+    flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+    packed_size = (flat.size + 7) // 8
+
+    if encoding == "rle" and flat.size:
+        changes = flat[1:] != flat[:-1]
+        # Every run takes at least one byte: give up on RLE before building
+        # run arrays when there are more runs than bitpacked bytes
+        if np.count_nonzero(changes) + 2 < packed_size:
+            boundaries = np.flatnonzero(changes) + 1
+            runs = np.diff(boundaries, prepend=0, append=flat.size)
+            if flat[0]:
+                runs = np.concatenate(([0], runs))
+            data = _varints(runs)
+            if len(data) < packed_size:
+                return "rle", data
+    elif encoding == "rle":
+        return "rle", b""
+
+    return "bitpack", np.packbits(flat).tobytes()
+
+def mask_payload(mask, encoding: str = "rle"):
+    """JSON-friendly encoded mask of a 2D slice, in display orientation."""
+    display = to_display(mask)
+    encoding, data = encode_mask(display, encoding)
+    return {
+        "shape": list(display.shape),
+        "encoding": encoding,
+        "data": base64.b64encode(data).decode("utf-8"),
+    }
+
+def read_slice_mask(img, plane: str, index: int, t: int = 0, value_range=None):
+    """Read one slice through the array proxy and segment it."""
+    return create_heart_mask(read_slice(img, plane, index, t), value_range)
+
+def volume_mask(img, t: int = 0, value_range=None):
+    """
+    Segment every axial slice of one frame.
 
-    # Normalize to 0-1
+    Returns:
+        Boolean array (slices, rows, cols), each slice in display orientation
+    """
+    data = load_frame(img, t)
+    return np.stack([
+        to_display(create_heart_mask(data[:, :, z], value_range)) for z in range(data.shape[2])
+    ])
+
+def window_slice(slice_data, stats: dict = None, bounds=None):
+    """
+    Map a 2D slice to uint8 gray levels.
+
+    With volume statistics and window bounds this is a lookup into a
+    precomputed table; otherwise the slice is min-max stretched.
+    """
+    if stats is not None and bounds is not None:
+        return apply_window(slice_data, stats, bounds)
+
+    slice_data = np.nan_to_num(slice_data)
     min_val = float(np.min(slice_data))
     max_val = float(np.max(slice_data))
     if max_val == min_val:
-        normalized = np.zeros(slice_data.shape)
-    else:
-        normalized = (slice_data - min_val) / (max_val - min_val)
+        return np.zeros(slice_data.shape, dtype=np.uint8)
+    return ((slice_data - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+
+def slice_to_png_gray(slice_data, stats: dict = None, bounds=None) -> bytes:
+    """
+    Encode a 2D slice as a plain grayscale PNG at native resolution
+    (one pixel per voxel, display orientation).
+    """
+    buffer = io.BytesIO()
+    mpimg.imsave(
+        buffer, to_display(window_slice(slice_data, stats, bounds)),
+        cmap='gray', vmin=0, vmax=255, format='png',
+    )
+    return buffer.getvalue()
+
+def slice_to_base64_gray(slice_data, stats: dict = None, bounds=None) -> str:
+    """Grayscale slice as a base64 PNG data URL."""
+    img_base64 = base64.b64encode(slice_to_png_gray(slice_data, stats, bounds)).decode('utf-8')
+    return f"data:image/png;base64,{img_base64}"
+
+def load_frame(img, t: int = 0):
+    """
+    Read a single 3D frame of a NIfTI image.
+
+    3D volumes are returned whole. For 4D cine data only timepoint ``t`` is
+    read through the array proxy, so memory stays proportional to one frame.
+    """
+    if len(img.shape) == 4:
+        return np.asarray(img.dataobj[..., t], dtype=np.float64)
+    return np.asarray(img.get_fdata())
+
+def read_slice(img, plane: str, index: int, t: int = 0):
+    """
+    Read one 2D slice of a (possibly 4D) NIfTI image through the array proxy.
+
+    Args:
+        img: Loaded nibabel image (header only, data not yet read)
+        plane: "axial", "coronal" or "sagittal"
+        index: Slice position along the plane's axis
+        t: Timepoint (must be 0 for 3D volumes)
+
+    Returns:
+        2D numpy array
+    """
+    if plane not in PLANE_AXES:
+        raise ValueError(f"Unknown plane '{plane}' (expected one of {', '.join(PLANE_AXES)})")
+
+    axis = PLANE_AXES[plane]
+    shape = img.shape
+    if not 0 <= index < shape[axis]:
+        raise ValueError(f"{plane} index {index} out of range 0-{shape[axis] - 1}")
+
+    slicer = [slice(None)] * 3
+    slicer[axis] = index
+    frames = shape[3] if len(shape) == 4 else 1
+    if not 0 <= t < frames:
+        raise ValueError(f"Timepoint {t} out of range 0-{frames - 1}")
+    if len(shape) == 4:
+        slicer.append(t)
+
+    return np.asarray(img.dataobj[tuple(slicer)], dtype=np.float64)
+
+def get_cine_frame(nifti_path: str, plane: str, index: int, t: int, img=None,
+                   stats: dict = None, bounds=None) -> bytes:
+    """
+    Render one cine frame (slice ``index`` of ``plane`` at timepoint ``t``)
+    as PNG bytes with the heart overlay. Rendered frames are cached.
+
+    With volume statistics every frame uses the same window and mask
+    normalization, so brightness stays stable across the cycle.
+    """
+    stat = os.stat(nifti_path)
+    value_range = mask_range(stats) if stats else None
+    key = (nifti_path, stat.st_mtime_ns, stat.st_size, plane, index, t, bounds, value_range)
+    with _cine_lock:
+        if key in _cine_cache:
+            _cine_cache.move_to_end(key)
+            return _cine_cache[key]
+
+    hit, png = get_shared_cache().get("cine", repr(key))
+    if hit:
+        _remember_cine_frame(key, png)
+        return png
+
+    if img is None:
+        img = nib.load(nifti_path, keep_file_open=True)
+    slice_data = read_slice(img, plane, index, t)
+    png = render_slice_png(slice_data, create_heart_mask(slice_data, value_range), stats, bounds)
+
+    get_shared_cache().put("cine", repr(key), png)
+    _remember_cine_frame(key, png)
+    return png
+
+def _remember_cine_frame(key, png: bytes):
+    with _cine_lock:
+        _cine_cache[key] = png
+        if len(_cine_cache) > CINE_CACHE_SIZE:
+            _cine_cache.popitem(last=False)
+
+def iter_cine_frames(nifti_path: str, plane: str, index: int = None,
+                     stats: dict = None, bounds=None):
+    """
+    Yield (timepoint, PNG bytes) for a fixed slice position across the
+    cardiac cycle. Only one frame's slice is held in memory at a time.
+    The center slice of the plane is used when ``index`` is None.
+    """
+    # One open (gzip) stream for the whole sequence: frames are read in
+    # order, so each read continues forward instead of decompressing from
+    # the start of the file again
+    img = nib.load(nifti_path, keep_file_open=True)
+    if len(img.shape) != 4:
+        raise ValueError("Scan is not a 4D cine series")
+    if index is None and plane in PLANE_AXES:
+        index = img.shape[PLANE_AXES[plane]] // 2
+
+    # Validate the slice position before streaming starts
+    read_slice(img, plane, index, 0)
+
+    for t in range(img.shape[3]):
+        yield t, get_cine_frame(nifti_path, plane, index, t, img=img, stats=stats, bounds=bounds)
+
+def clear_cine_cache(nifti_path: str = None):
+    """Drop this worker's in-memory cine frames for one file, or all of them."""
+    with _cine_lock:
+        if nifti_path is None:
+            _cine_cache.clear()
+            return
+        for key in [k for k in _cine_cache if k[0] == nifti_path]:
+            del _cine_cache[key]
+
+def render_slice_png(slice_data, mask, stats: dict = None, bounds=None) -> bytes:
+    """
+    Window a 2D slice, apply RED heart segmentation overlay using matplotlib.
+
+    Args:
+        slice_data: 2D numpy array
+        mask: 2D boolean array (heart segmentation)
+        stats: Volume intensity statistics (optional)
+        bounds: (low, high) display window; min-max stretch if omitted
+
+    Returns:
+        bytes: PNG image
+    """
+    gray = window_slice(slice_data, stats, bounds)
 
     # Create figure
-    fig, ax = plt.subplots(figsize=(6, 6), dpi=100)
+    fig = Figure(figsize=(6, 6), dpi=100)
+    ax = fig.subplots()
     ax.axis('off')
 
     # Show grayscale image
-    ax.imshow(normalized.T, cmap='gray', origin='lower')
+    ax.imshow(gray.T, cmap='gray', origin='lower', vmin=0, vmax=255)
 
     # Apply red overlay on heart mask - FIXED: Create RGBA array with correct shape
     red_overlay = np.zeros((*mask.T.shape, 4))  # Transpose mask first
@@ -230,18 +549,6 @@ def slice_to_base64_with_overlay(slice_data, mask, name: str) -> str:
 
     # Save to bytes buffer
     buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0)
-    buffer.seek(0)
-    plt.close(fig)
+    fig.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0)
 
-    # Convert to base64
-    img_base64 = base64.b64encode(buffer.read()).decode('utf-8')
-
-    # Also save to file for debugging
-    file_path = os.path.join(SLICE_DIR, f"{name}_heart_segmented.png")
-    with open(file_path, 'wb') as f:
-        f.write(base64.b64decode(img_base64))
-    print(f"💾 Saved {name} slice with heart segmentation to {file_path}")
-
-    # Return as data URL
-    return f"data:image/png;base64,{img_base64}"
+    return buffer.getvalue()
@@ -0,0 +1,232 @@
+"""
+intensity.py
+========================================
+Volume Intensity Statistics and Window/Level
+Single streaming histogram pass + lookup-table windowing
+========================================
+"""
+
+import json
+import os
+from functools import lru_cache
+
+import nibabel as nib
+import numpy as np
+
+from shared_cache import atomic_write
+
+HIST_BINS = 4096
+SLAB_VOXELS = 8 * 1024 * 1024  # voxels read per chunk during the streaming pass
+PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+STATS_FORMAT = 1  # bump when the saved statistics layout changes
+
+# CT window presets in Hounsfield units: (window width, window level)
+WINDOW_PRESETS = {
+    "cardiac": (600.0, 200.0),
+    "mediastinal": (350.0, 50.0),
+    "lung": (1500.0, -600.0),
+}
+# Presets derived from each volume's own statistics (work for MRI too)
+AUTO_PRESETS = ("auto", "minmax")
+
+class StreamingHistogram:
+    """
+    Fixed-size histogram whose range grows as data arrives.
+
+    The range starts at the first chunk's extent. When later values fall
+    outside it, the range doubles (merging adjacent bins) until they fit,
+    so one pass over the data is enough.
+    """
+
+    def __init__(self, bins: int = HIST_BINS):
+        self.bins = bins
+        self.counts = None
+        self.lo = 0.0
+        self.width = 1.0
+        self.total = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _grow(self, vmin: float, vmax: float):
+        while vmin < self.lo or vmax >= self.lo + self.width * self.bins:
+            merged = self.counts.reshape(-1, 2).sum(axis=1)
+            pad = np.zeros(self.bins // 2, dtype=np.int64)
+            if vmin < self.lo:
+                # Extend downwards: old range becomes the upper half
+                self.lo -= self.width * self.bins
+                self.counts = np.concatenate([pad, merged])
+            else:
+                self.counts = np.concatenate([merged, pad])
+            self.width *= 2
+
+    def update(self, values):
+        """Add a 1D array of finite values."""
+        if values.size == 0:
+            return
+        vmin = float(values.min())
+        vmax = float(values.max())
+
+        if self.counts is None:
+            self.lo = vmin
+            self.width = max((vmax - vmin) / self.bins, 1e-6) * 1.0001
+            self.counts = np.zeros(self.bins, dtype=np.int64)
+        else:
+            self._grow(vmin, vmax)
+
+        idx = ((values - self.lo) / self.width).astype(np.intp)
+        np.clip(idx, 0, self.bins - 1, out=idx)
+        self.counts += np.bincount(idx, minlength=self.bins)
+
+        self.total += values.size
+        self.sum += float(values.sum())
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def percentile(self, p: float) -> float:
+        """Percentile estimate, interpolated within the containing bin."""
+        cdf = np.cumsum(self.counts)
+        target = p / 100.0 * self.total
+        idx = int(np.searchsorted(cdf, target))
+        idx = min(idx, self.bins - 1)
+        below = cdf[idx - 1] if idx > 0 else 0
+        in_bin = self.counts[idx]
+        frac = (target - below) / in_bin if in_bin else 0.0
+        value = self.lo + (idx + frac) * self.width
+        return float(min(max(value, self.min), self.max))
+
+def scan_intensity(nifti_path: str, bins: int = HIST_BINS):
+    """
+    Build a global intensity histogram and percentiles for a scan in a
+    single streaming pass (all timepoints for 4D cine).
+
+    The file is read in slabs along its slowest-varying axes, so offsets
+    only move forward and memory stays proportional to one slab.
+
+    Returns:
+        dict: min, max, mean, voxels, percentiles and the histogram
+        (lo, width, counts)
+    """
+    try:
+        img = nib.load(nifti_path, keep_file_open=True)
+    except Exception as e:
+        raise ValueError(f"Invalid NIfTI file: {str(e)}")
+
+    shape = img.shape
+    frames = shape[3] if len(shape) == 4 else 1
+    slab_depth = max(1, SLAB_VOXELS // (shape[0] * shape[1]))
+    hist = StreamingHistogram(bins)
+
+    for t in range(frames):
+        for z0 in range(0, shape[2], slab_depth):
+            slicer = (slice(None), slice(None), slice(z0, z0 + slab_depth))
+            if len(shape) == 4:
+                slicer += (t,)
+            slab = np.asarray(img.dataobj[slicer], dtype=np.float64).ravel()
+            hist.update(slab[np.isfinite(slab)])
+
+    if hist.counts is None:
+        raise ValueError("Scan contains no finite voxel values")
+
+    stats = {
+        "min": hist.min,
+        "max": hist.max,
+        "mean": hist.sum / hist.total,
+        "voxels": hist.total,
+        "percentiles": {str(p): hist.percentile(p) for p in PERCENTILES},
+        "histogram": {"lo": hist.lo, "width": hist.width, "counts": hist.counts},
+    }
+    print(f"📈 Intensity range {stats['min']:.1f} to {stats['max']:.1f}, "
+          f"p1-p99 {stats['percentiles']['1']:.1f} to {stats['percentiles']['99']:.1f}")
+    return stats
+
+def stats_path(nifti_path: str) -> str:
+    """Hidden sidecar file next to the scan holding its saved statistics."""
+    directory, name = os.path.split(nifti_path)
+    return os.path.join(directory, f".{name}.stats.json")
+
+def has_saved_intensity(nifti_path: str) -> bool:
+    return os.path.exists(stats_path(nifti_path))
+
+def save_intensity(nifti_path: str, stats: dict):
+    """Write a scan's statistics next to it (atomically, for other workers)."""
+    payload = dict(stats, format=STATS_FORMAT)
+    payload["histogram"] = dict(stats["histogram"], counts=stats["histogram"]["counts"].tolist())
+
+    atomic_write(stats_path(nifti_path), json.dumps(payload).encode("utf-8"))
+
+def load_intensity(nifti_path: str):
+    """Statistics saved by save_intensity(), or None if absent or stale."""
+    try:
+        with open(stats_path(nifti_path)) as f:
+            payload = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if payload.pop("format", None) != STATS_FORMAT:
+        return None
+
+    payload["histogram"]["counts"] = np.asarray(payload["histogram"]["counts"], dtype=np.int64)
+    return payload
+
+def summarize_intensity(stats: dict):
+    """JSON-friendly intensity summary (histogram downsampled to 64 bins)."""
+    counts = stats["histogram"]["counts"]
+    return {
+        "min": stats["min"],
+        "max": stats["max"],
+        "mean": stats["mean"],
+        "percentiles": stats["percentiles"],
+        "histogram": {
+            "lo": stats["histogram"]["lo"],
+            "width": stats["histogram"]["width"] * (len(counts) // 64),
+            "counts": counts.reshape(64, -1).sum(axis=1).tolist(),
+        },
+        "window_presets": list(AUTO_PRESETS) + list(WINDOW_PRESETS),
+    }
+
+def resolve_window(stats: dict, preset: str = "auto", window: float = None, level: float = None):
+    """
+    Turn a preset name or a custom window/level into (low, high) bounds.
+
+    "auto" spans the 1st-99th percentiles and "minmax" the full range;
+    a custom window and level override the preset.
+    """
+    if window is not None and level is not None:
+        if window <= 0:
+            raise ValueError("Window width must be positive")
+        return level - window / 2, level + window / 2
+
+    if preset == "auto":
+        low, high = stats["percentiles"]["1"], stats["percentiles"]["99"]
+    elif preset == "minmax":
+        low, high = stats["min"], stats["max"]
+    elif preset in WINDOW_PRESETS:
+        width, center = WINDOW_PRESETS[preset]
+        return center - width / 2, center + width / 2
+    else:
+        raise ValueError(
+            f"Unknown window preset '{preset}' "
+            f"(expected one of {', '.join(list(AUTO_PRESETS) + list(WINDOW_PRESETS))})"
+        )
+
+    if high <= low:
+        high = low + 1.0
+    return low, high
+
+@lru_cache(maxsize=64)
+def _window_lut(lo: float, width: float, bins: int, low: float, high: float):
+    centers = lo + (np.arange(bins) + 0.5) * width
+    return (np.clip((centers - low) / (high - low), 0.0, 1.0) * 255).astype(np.uint8)
+
+def apply_window(slice_data, stats: dict, bounds: tuple):
+    """
+    Map a slice to uint8 display values through a lookup table over the
+    volume's histogram bins, so no reduction over the slice is needed.
+    """
+    hist = stats["histogram"]
+    bins = len(hist["counts"])
+    lut = _window_lut(hist["lo"], hist["width"], bins, float(bounds[0]), float(bounds[1]))
+
+    idx = ((np.nan_to_num(slice_data) - hist["lo"]) / hist["width"]).astype(np.intp)
+    np.clip(idx, 0, bins - 1, out=idx)
+    return lut[idx]
@@ -12,25 +12,105 @@ Serves HTML files, static files, and handles API requests
 
 """
 
+import time
+PROCESS_START = time.time()
+
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import Request
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 import uvicorn
+import asyncio
 import os
+import sys
 import shutil
+import hashlib
+import itertools
+import threading
+import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
 
 # Import custom modules
-from imaging import process_nifti
-from ai_engine import run_ai_analysis
+# The imaging stack (imaging, pipeline, intensity -> nibabel, matplotlib)
+# is imported lazily inside the endpoints and preloaded by warm_up(), so
+# importing this module stays cheap in every worker process.
+from admission import (
+    AdmissionController,
+    AdmissionRejected,
+    ADMISSION_PUBLISH_S,
+    estimate_job_cost,
+    merge_stats,
+)
+from shared_cache import get_shared_cache
+
+# =========================================================
+# DIRECTORY SETUP
+# =========================================================
+BASE_DIR = Path(__file__).parent.absolute()
+UPLOAD_DIR = BASE_DIR / "uploads"
+SLICES_DIR = BASE_DIR / "slices"
+
+# =========================================================
+# STARTUP / WARM-UP
+# =========================================================
+# Per-worker readiness, reported by /ready
+STARTUP = {"ready": False, "warmup_s": None, "ready_after_s": None,
+           "first_request_s": None, "error": None}
+
+def warm_up():
+    """Import the imaging stack and render once so requests don't pay for it."""
+    start = time.time()
+    try:
+        import numpy as np
+        from imaging import slice_to_png_gray, render_slice_png
+
+        demo = np.linspace(0.0, 1.0, 64).reshape(8, 8)
+        slice_to_png_gray(demo)
+        render_slice_png(demo, demo > 0.5)
+        get_pipeline()
+    except Exception as e:
+        STARTUP["error"] = str(e)
+        print(f"❌ Warm-up failed: {e}")
+
+    STARTUP["warmup_s"] = round(time.time() - start, 3)
+    STARTUP["ready_after_s"] = round(time.time() - PROCESS_START, 3)
+    STARTUP["ready"] = STARTUP["error"] is None
+    print(f"🔥 Worker {os.getpid()} ready: warm-up {STARTUP['warmup_s']:.2f}s, "
+          f"{STARTUP['ready_after_s']:.2f}s since process start")
+
+def publish_admission_stats():
+    """Write this worker's admission snapshot where every worker can read it."""
+    get_shared_cache().put("admission", str(os.getpid()), admission.snapshot())
+
+async def admission_publisher():
+    """Republish periodically so /api/admission can tell live workers apart."""
+    while True:
+        try:
+            await run_in_threadpool(publish_admission_stats)
+        except OSError as e:
+            print(f"⚠️  Could not publish admission stats: {e}")
+        await asyncio.sleep(ADMISSION_PUBLISH_S)
+
+@asynccontextmanager
+async def lifespan(app):
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    SLICES_DIR.mkdir(exist_ok=True)
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    publisher = asyncio.create_task(admission_publisher())
+    yield
+    publisher.cancel()
+    get_shared_cache().delete("admission", str(os.getpid()))
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Cardiology AI Backend",
     description="Backend API for AI-powered cardiac disease detection",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # =========================================================
@@ -42,26 +122,139 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Mask-Shape", "X-Mask-Encoding"],
 )
 
-# =========================================================
-# DIRECTORY SETUP
-# =========================================================
-BASE_DIR = Path(__file__).parent.absolute()
-UPLOAD_DIR = BASE_DIR / "uploads"
-SLICES_DIR = BASE_DIR / "slices"
-UPLOAD_DIR.mkdir(exist_ok=True)
-SLICES_DIR.mkdir(exist_ok=True)
+@app.middleware("http")
+async def record_first_request(request: Request, call_next):
+    """Record this worker's time from process start to its first served request."""
+    response = await call_next(request)
+    if STARTUP["first_request_s"] is None and request.url.path not in ("/ready", "/health"):
+        STARTUP["first_request_s"] = round(time.time() - PROCESS_START, 3)
+        print(f"⏱️  First request ({request.url.path}) served "
+              f"{STARTUP['first_request_s']:.2f}s after process start")
+    return response
+
+# Memory/concurrency gate in front of NIfTI processing (per worker)
+admission = AdmissionController()
+
+# Memoized ingest → load → segment → measure → render → infer → report
+# stages, shared between workers through the on-disk cache
+_pipeline = None
+_pipeline_lock = threading.Lock()
 
-print(f"📁 Base directory: {BASE_DIR}")
-print(f"📁 Upload directory: {UPLOAD_DIR}")
-print(f"📁 Slices directory: {SLICES_DIR}")
+def get_pipeline():
+    """The analysis pipeline, created (and its imports loaded) on first use."""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            from pipeline import AnalysisPipeline, StageCache
+            _pipeline = AnalysisPipeline(StageCache(shared=get_shared_cache()))
+    return _pipeline
+
+# Shared-cache generation this worker's in-memory caches belong to
+_cache_generation = None
+
+def sync_local_caches():
+    """
+    Drop this worker's in-memory cine frames and stage outputs if the
+    shared cache was cleared (by any worker) since they were filled.
+    """
+    global _cache_generation
+    generation = get_shared_cache().generation()
+    if generation == _cache_generation:
+        return
+    imaging = sys.modules.get("imaging")
+    if imaging is not None:
+        imaging.clear_cine_cache()
+    if _pipeline is not None:
+        _pipeline.cache.clear_local()
+    _cache_generation = generation
+
+@app.middleware("http")
+async def check_cache_generation(request: Request, call_next):
+    """Pick up /api/clear-data from other workers before serving a request."""
+    sync_local_caches()
+    return await call_next(request)
+
+async def save_upload(upload: UploadFile, path: Path) -> str:
+    """Write an upload to disk in chunks and return its SHA-1 hex digest."""
+    digest = hashlib.sha1()
+    with open(path, "wb") as f:
+        while True:
+            chunk = await upload.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+STUDY_ID_CHARS = set("0123456789abcdef")
+
+def get_study_path(study_id: str) -> Path:
+    """
+    Find an uploaded study or raise 404. Uploads are stored as
+    ``<study_id>_<filename>``, so every worker can resolve them from the
+    upload directory alone.
+    """
+    if len(study_id) == 16 and set(study_id) <= STUDY_ID_CHARS:
+        for ct_path in UPLOAD_DIR.glob(f"{study_id}_*"):
+            if ct_path.is_file():
+                return ct_path
+    raise HTTPException(status_code=404, detail=f"Study {study_id} not found")
+
+def admission_error(e: AdmissionRejected) -> HTTPException:
+    """429/413 response for a rejected job, with Retry-After when known."""
+    headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+    return HTTPException(status_code=e.status_code, detail=e.reason, headers=headers)
+
+def admitted_stages(ct_path: Path) -> dict:
+    """
+    Stages that read voxel data and so may only run while holding an
+    admission slot, as an ``allow`` map for the pipeline: load always,
+    ingest unless the scan's intensity statistics are already saved.
+    """
+    from intensity import has_saved_intensity
+
+    allow = {"load": False}
+    if not has_saved_intensity(str(ct_path)):
+        allow["ingest"] = False
+    return allow
+
+async def study_header(ct_path: Path, study_id: str) -> dict:
+    """
+    The study's ingest stage (header and intensity statistics). A miss
+    that needs a streaming pass over the scan waits for admission first.
+    """
+    from pipeline import StageNotAllowed
+
+    pipeline = get_pipeline()
+    try:
+        return await run_in_threadpool(
+            pipeline.stage, str(ct_path), study_id, "ingest", admitted_stages(ct_path)
+        )
+    except StageNotAllowed:
+        async with admission.admit(estimate_job_cost(str(ct_path))):
+            return await run_in_threadpool(pipeline.stage, str(ct_path), study_id, "ingest")
+
+async def study_window(ct_path: Path, study_id: str, preset: str,
+                       window: Optional[float], level: Optional[float]):
+    """
+    Intensity statistics stored with the study (from the cached ingest
+    stage) and the (low, high) display window for a preset or custom
+    window/level.
+    """
+    from intensity import resolve_window
+
+    header = await study_header(ct_path, study_id)
+    stats = header["intensity"]
+    return stats, resolve_window(stats, preset, window, level)
 
 # =========================================================
 # MOUNT STATIC FILES (for images, slices, etc.)
 # =========================================================
 # Serve slices directory under /slices
-app.mount("/slices", StaticFiles(directory=str(SLICES_DIR)), name="slices")
+app.mount("/slices", StaticFiles(directory=str(SLICES_DIR), check_dir=False), name="slices")
 
 # =========================================================
 # SERVE HTML FILES (MUST BE BEFORE CATCH-ALL ROUTES)
@@ -155,10 +348,18 @@ async def analyze_heart(
         # SAVE UPLOADED FILES
         # =====================================================
         # Save CT/MRI scan (mandatory)
-        ct_path = UPLOAD_DIR / ct_mri_file.filename
-        with open(ct_path, "wb") as f:
-            content = await ct_mri_file.read()
-            f.write(content)
+        # Content-addressed name, so concurrent uploads of different scans
+        # with the same filename can't overwrite each other in any worker
+        tmp_path = UPLOAD_DIR / f".upload-{uuid.uuid4().hex}"
+        try:
+            study_id = (await save_upload(ct_mri_file, tmp_path))[:16]
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        ct_path = UPLOAD_DIR / f"{study_id}_{Path(ct_mri_file.filename).name}"
+        # A resubmitted scan keeps its existing file if admission fails
+        new_upload = not ct_path.exists()
+        os.replace(tmp_path, ct_path)
         print(f"✅ Saved CT/MRI to: {ct_path}")
         
         # Save optional files
@@ -184,57 +385,58 @@ async def analyze_heart(
             print(f"✅ Saved ECHO: {echo_file.filename}")
         
         # =====================================================
-        # PROCESS CT/MRI WITH HEART SEGMENTATION
+        # RUN STAGED PIPELINE (IMAGING + AI ANALYSIS)
         # =====================================================
-        print("🔄 Processing NIfTI file with heart segmentation...")
-        import time
         start_time = time.time()
-        
-        meta, resolution, measurements, slices_data, sliders = process_nifti(str(ct_path))
-        
-        elapsed = time.time() - start_time
-        print(f"✅ NIfTI processing complete ({elapsed:.2f}s)")
-        print(f"   Shape: {resolution['image_size']}")
-        print(f"   Slices: {resolution['num_slices']}")
-        
-        # =====================================================
-        # RUN AI ANALYSIS
-        # =====================================================
-        print("🤖 Running AI disease detection analysis...")
-        ai_start = time.time()
-        
-        ai_summary, diseases, label_stats, preview3d = run_ai_analysis()
-        
-        ai_result = {
-            "finding": ai_summary["label"],
-            "confidence_score": f"{int(ai_summary['confidence'] * 100)}%",
-            "explanation": ai_summary["explanation"],
-            "diseases": diseases,
-            "label_stats": label_stats,
-        }
-        
-        ai_elapsed = time.time() - ai_start
-        print(f"✅ AI analysis complete ({ai_elapsed:.2f}s)")
-        print(f"   Finding: {ai_result['finding']}")
-        print(f"   Confidence: {ai_result['confidence_score']}")
-        
+
+        pipeline = get_pipeline()
+        from pipeline import StageNotAllowed
+        patient = {"age": patient_age, "sex": patient_sex, "notes": patient_notes}
+        to_run = pipeline.plan(str(ct_path), study_id, patient)
+        print(f"🧩 Stages to run: {', '.join(to_run) or 'none (all cached)'}")
+
+        report = None
+        allow = admitted_stages(ct_path)
+        if all(allow.get(stage, True) for stage in to_run):
+            # Cached volume: run without a slot, but never read voxel data
+            # outside one (entries may be evicted between plan() and run())
+            try:
+                report, trace = await run_in_threadpool(
+                    pipeline.run, str(ct_path), study_id, patient, allow
+                )
+            except StageNotAllowed:
+                print("🧩 Volume evicted since planning, waiting for admission")
+
+        if report is None:
+            # Estimate cost from the header alone and wait for capacity
+            cost = estimate_job_cost(str(ct_path))
+            print(f"🚦 Estimated cost: ~{cost['memory_bytes'] // 1024 // 1024} MB, {cost['cpu_mvoxels']:.1f} Mvoxels")
+
+            async with admission.admit(cost):
+                report, trace = await run_in_threadpool(pipeline.run, str(ct_path), study_id, patient)
+
+        for step in trace:
+            print(f"   {step['stage']:<8} {step['status']:<10} {step['elapsed_ms']:.1f} ms")
+        print(f"   Finding: {report['ai_analysis']['finding']}")
+        print(f"   Confidence: {report['ai_analysis']['confidence_score']}")
+
         # =====================================================
         # PREPARE RESPONSE
         # =====================================================
         response_data = {
             "status": "success",
+            "study_id": study_id,
             "patient_info": {
                 "name": patient_name,
                 "age": patient_age,
                 "sex": patient_sex,
                 "notes": patient_notes,
             },
-            "scan_metadata": meta,
-            "resolution": resolution,
-            "measurements": measurements,
-            "slices": slices_data,
-            "sliders": sliders,
-            "ai_analysis": ai_result,
+            **report,
+            "pipeline": {
+                "stages": trace,
+                "cache_hits": sum(1 for step in trace if step["status"] == "cache_hit"),
+            },
         }
         
         total_time = time.time() - start_time
@@ -244,6 +446,10 @@ async def analyze_heart(
         
         return JSONResponse(content=response_data)
         
+    except AdmissionRejected as e:
+        if new_upload:
+            ct_path.unlink(missing_ok=True)
+        raise admission_error(e)
     except Exception as e:
         print("=" * 60)
         print("❌ ERROR OCCURRED")
@@ -252,6 +458,165 @@ async def analyze_heart(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# =========================================================
+# CINE STREAMING ENDPOINT (4D SCANS)
+# =========================================================
+CINE_BOUNDARY = "cineframe"
+
+@app.get("/api/studies/{study_id}/cine")
+async def stream_cine(
+    study_id: str,
+    plane: str = "axial",
+    index: Optional[int] = None,
+    preset: str = "auto",
+    window: Optional[float] = None,
+    level: Optional[float] = None,
+):
+    """
+    Stream one slice position of a 4D cine scan across the cardiac cycle.
+
+    Frames are sent as a multipart/x-mixed-replace PNG sequence, so the
+    URL can be used directly as an <img> source. Each part carries an
+    X-Frame-Index header with its timepoint.
+    """
+    from imaging import iter_cine_frames
+
+    ct_path = get_study_path(study_id)
+
+    try:
+        stats, bounds = await study_window(ct_path, study_id, preset, window, level)
+        frames = iter_cine_frames(str(ct_path), plane, index, stats=stats, bounds=bounds)
+        # Pull the first frame eagerly so bad parameters become a 400
+        first = await run_in_threadpool(next, frames, None)
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if first is None:
+        raise HTTPException(status_code=400, detail="Scan has no frames")
+
+    def multipart():
+        for t, png in itertools.chain([first], frames):
+            yield (
+                f"--{CINE_BOUNDARY}\r\n"
+                f"Content-Type: image/png\r\n"
+                f"Content-Length: {len(png)}\r\n"
+                f"X-Frame-Index: {t}\r\n\r\n"
+            ).encode() + png + b"\r\n"
+        yield f"--{CINE_BOUNDARY}--\r\n".encode()
+
+    return StreamingResponse(
+        multipart(),
+        media_type=f"multipart/x-mixed-replace; boundary={CINE_BOUNDARY}",
+    )
+
+# =========================================================
+# SLICE + MASK ENDPOINTS (CLIENT-SIDE OVERLAY)
+# =========================================================
+@app.get("/api/studies/{study_id}/slice")
+async def get_slice(
+    study_id: str,
+    plane: str = "axial",
+    index: int = 0,
+    t: int = 0,
+    preset: str = "auto",
+    window: Optional[float] = None,
+    level: Optional[float] = None,
+):
+    """
+    Plain grayscale PNG of one slice at native resolution, without the
+    heart overlay (composite it with /mask in the browser).
+
+    ``preset`` is "auto" (1st-99th percentile), "minmax", or a CT preset
+    ("cardiac", "mediastinal", "lung"); ``window`` + ``level`` set a custom
+    window. Windowing is a lookup into a table built from the study's
+    precomputed histogram, so no pass over the data is needed.
+    """
+    import nibabel as nib
+    from imaging import read_slice, slice_to_png_gray
+
+    ct_path = get_study_path(study_id)
+
+    try:
+        stats, bounds = await study_window(ct_path, study_id, preset, window, level)
+
+        # Rendered slices are shared across workers via the on-disk cache
+        cache_key = repr((study_id, plane, index, t, bounds))
+        hit, png = get_shared_cache().get("slices", cache_key)
+        if not hit:
+            def render():
+                slice_data = read_slice(nib.load(str(ct_path)), plane, index, t)
+                return slice_to_png_gray(slice_data, stats, bounds)
+
+            png = await run_in_threadpool(render)
+            get_shared_cache().put("slices", cache_key, png)
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=png, media_type="image/png")
+
+@app.get("/api/studies/{study_id}/mask")
+async def get_mask(
+    study_id: str,
+    plane: Optional[str] = None,
+    index: int = 0,
+    t: int = 0,
+    encoding: str = "rle",
+):
+    """
+    Heart segmentation mask as compact binary ("rle" or "bitpack"; "rle"
+    falls back to "bitpack" when smaller, see X-Mask-Encoding).
+
+    With a plane, returns that slice's mask; without one, returns the whole
+    volume as a stack of axial slices. The X-Mask-Shape header gives the
+    decoded shape (rows,cols or slices,rows,cols) in display orientation.
+    """
+    import nibabel as nib
+    from imaging import read_slice_mask, volume_mask, mask_range, encode_mask, to_display, MASK_ENCODINGS
+
+    ct_path = get_study_path(study_id)
+    if encoding not in MASK_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f"Unknown mask encoding '{encoding}'")
+
+    try:
+        header = await study_header(ct_path, study_id)
+        value_range = mask_range(header["intensity"])
+
+        img = nib.load(str(ct_path))
+        if plane is not None:
+            def segment():
+                mask = to_display(read_slice_mask(img, plane, index, t, value_range))
+                return mask.shape, encode_mask(mask, encoding)
+
+            shape, (encoding, data) = await run_in_threadpool(segment)
+        else:
+            # The whole frame is loaded, so segment and encode it while
+            # holding the admission slot (off the event loop)
+            frames = img.shape[3] if len(img.shape) == 4 else 1
+            if not 0 <= t < frames:
+                raise ValueError(f"Timepoint {t} out of range 0-{frames - 1}")
+
+            def segment():
+                mask = volume_mask(img, t, value_range)
+                return mask.shape, encode_mask(mask, encoding)
+
+            async with admission.admit(estimate_job_cost(str(ct_path))):
+                shape, (encoding, data) = await run_in_threadpool(segment)
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return Response(
+        content=data,
+        media_type="application/octet-stream",
+        headers={
+            "X-Mask-Shape": ",".join(str(n) for n in shape),
+            "X-Mask-Encoding": encoding,
+        },
+    )
+
 # =========================================================
 # CLEAR DATA ENDPOINT
 # =========================================================
@@ -279,6 +644,12 @@ async def clear_data():
                 if file.is_file():
                     file.unlink()
                     print(f"   Deleted: {file.name}")
+
+        # Forget cached cine frames, slices and stage outputs. Clearing the
+        # shared cache starts a new generation, so every worker drops its
+        # in-memory copies on its next request (this one does so now).
+        get_shared_cache().clear()
+        sync_local_caches()
         
         print("✅ All data cleared successfully")
         print("=" * 60)
@@ -301,6 +672,27 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "Cardiology AI Backend"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once this worker has finished warm-up, 503 before"""
+    body = {"pid": os.getpid(), **STARTUP}
+    return JSONResponse(content=body, status_code=200 if STARTUP["ready"] else 503)
+
+@app.get("/api/admission")
+async def admission_stats():
+    """
+    Admission load, decisions and queue wait times across all workers
+    (each worker publishes a snapshot every few seconds; ones that stopped
+    publishing are left out), plus the pid of the worker that answered.
+    """
+    def collect():
+        publish_admission_stats()
+        cutoff = time.time() - 3 * ADMISSION_PUBLISH_S
+        return [snap for snap in get_shared_cache().values("admission") if snap["published_at"] >= cutoff]
+
+    snapshots = await run_in_threadpool(collect)
+    return {"answered_by": os.getpid(), **merge_stats(snapshots)}
+
 # =========================================================
 # CATCH-ALL ROUTE FOR STATIC FILES (MUST BE LAST!)
 # =========================================================
@@ -320,22 +712,56 @@ async def serve_static_file(filename: str):
 # RUN SERVER
 # =========================================================
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cardiology AI Backend Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("CARDIO_WORKERS", "1")),
+        help="worker processes; caches are shared through CARDIO_CACHE_DIR and "
+             "CARDIO_MEMORY_BUDGET_MB is split between workers",
+    )
+    args = parser.parse_args()
+
+    # Inherited by worker processes so each takes its share of the budget
+    os.environ["CARDIO_WORKERS"] = str(args.workers)
+    admission = AdmissionController()
+
     print("=" * 60)
     print("🫀 Starting Cardiology AI Backend Server...")
     print("=" * 60)
-    print("📡 Access at: http://localhost:8000")
-    print("📚 API Docs: http://localhost:8000/docs")
-    print("🌐 Analysis Page: http://localhost:8000")
-    print("📊 Results Page: http://localhost:8000/result.html")
+    print(f"📁 Base directory: {BASE_DIR}")
+    print(f"📁 Upload directory: {UPLOAD_DIR}")
+    print(f"📁 Slices directory: {SLICES_DIR}")
+    print(f"📁 Shared cache: {get_shared_cache().root}")
+    print(f"👷 Workers: {args.workers}")
+    print(f"📡 Access at: http://localhost:{args.port}")
+    print(f"📚 API Docs: http://localhost:{args.port}/docs")
+    print(f"🌐 Analysis Page: http://localhost:{args.port}")
+    print(f"📊 Results Page: http://localhost:{args.port}/result.html")
+    print(f"🚦 Readiness: http://localhost:{args.port}/ready")
     print()
     print("✅ CORS enabled - accepts requests from any origin")
     print("✅ Static file serving enabled")
     print("=" * 60)
     print()
-    
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000,
-        log_level="info",
-    )
+
+    if args.workers > 1:
+        # Multiple processes need an import string; each worker imports
+        # this module (cheap) and warms up the imaging stack on startup
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            app_dir=str(BASE_DIR),
+            log_level="info",
+        )
+    else:
+        uvicorn.run(
+            app,
+            host=args.host,
+            port=args.port,
+            log_level="info",
+        )
@@ -0,0 +1,265 @@
+"""
+pipeline.py
+========================================
+Staged Analysis Pipeline with Per-Stage Memoization
+ingest → load → segment → measure → render → infer → report
+========================================
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from imaging import (
+    read_header,
+    load_center_slices,
+    segment_slices,
+    render_slices,
+    compute_measurements,
+    describe_scan,
+)
+from intensity import scan_intensity, summarize_intensity, load_intensity, save_intensity
+from ai_engine import run_ai_analysis
+
+# Bump a stage's version when its implementation changes so old cache
+# entries stop matching.
+STAGE_VERSIONS = {
+    "ingest": 3,
+    "load": 1,
+    "segment": 3,
+    "measure": 1,
+    "render": 4,
+    "infer": 1,
+    "report": 3,
+}
+
+STAGE_CACHE_ENTRIES = int(os.environ.get("CARDIO_STAGE_CACHE_ENTRIES", "32"))
+
+def stage_key(stage: str, *inputs) -> str:
+    """Hash a stage name, its version and its inputs into a cache key."""
+    payload = json.dumps([stage, STAGE_VERSIONS[stage], list(inputs)], default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+class StageNotAllowed(Exception):
+    """Raised when a stage would have to run but the caller disallowed it."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Stage '{stage}' is not cached and may not run here")
+        self.stage = stage
+
+class StageCache:
+    """
+    In-memory LRU of stage outputs, one bucket per stage.
+
+    With a ``shared`` SharedCache, entries are also written to disk so any
+    worker process can serve a stage another worker computed; disk hits
+    are promoted into the local LRU.
+    """
+
+    def __init__(self, max_entries: int = STAGE_CACHE_ENTRIES, shared=None):
+        self.max_entries = max_entries
+        self.shared = shared
+        self._buckets = {stage: OrderedDict() for stage in STAGE_VERSIONS}
+        self._lock = threading.Lock()
+
+    def has(self, stage: str, key: str) -> bool:
+        with self._lock:
+            if key in self._buckets[stage]:
+                return True
+        return self.shared is not None and self.shared.has(f"stage-{stage}", key)
+
+    def get(self, stage: str, key: str):
+        """Return (hit, value)."""
+        with self._lock:
+            bucket = self._buckets[stage]
+            if key in bucket:
+                bucket.move_to_end(key)
+                return True, bucket[key]
+
+        if self.shared is None:
+            return False, None
+        hit, value = self.shared.get(f"stage-{stage}", key)
+        if hit:
+            self._remember(stage, key, value)
+        return hit, value
+
+    def put(self, stage: str, key: str, value):
+        if self.shared is not None:
+            self.shared.put(f"stage-{stage}", key, value)
+        self._remember(stage, key, value)
+
+    def _remember(self, stage: str, key: str, value):
+        with self._lock:
+            bucket = self._buckets[stage]
+            bucket[key] = value
+            bucket.move_to_end(key)
+            if len(bucket) > self.max_entries:
+                bucket.popitem(last=False)
+
+    def clear_local(self):
+        """Drop this process's in-memory entries only."""
+        with self._lock:
+            for bucket in self._buckets.values():
+                bucket.clear()
+
+    def clear(self):
+        self.clear_local()
+        if self.shared is not None:
+            for stage in STAGE_VERSIONS:
+                self.shared.clear(f"stage-{stage}")
+
+class AnalysisPipeline:
+    """
+    Runs the analysis as a graph of memoized stages.
+
+    Every stage key is derived from its upstream keys plus its own
+    parameters, so keys are known before any stage runs. Stages are then
+    resolved lazily from the report backwards: a cached stage never asks
+    for its inputs. Resubmitting the same scan with a different patient
+    age therefore reruns only ``infer`` (and the cheap ``report``).
+    """
+
+    def __init__(self, cache: StageCache = None):
+        self.cache = cache or StageCache()
+
+    def _graph(self, nifti_path: str, study_id: str, patient: dict):
+        """Build {stage: (key, deps, fn)} for one request."""
+        keys = {}
+        keys["ingest"] = stage_key("ingest", study_id)
+        keys["load"] = stage_key("load", keys["ingest"])
+        keys["segment"] = stage_key("segment", keys["load"])
+        keys["measure"] = stage_key("measure", keys["ingest"])
+        keys["render"] = stage_key("render", keys["load"], keys["segment"])
+        keys["infer"] = stage_key(
+            "infer", keys["measure"], patient.get("age"), patient.get("sex"), patient.get("notes")
+        )
+        keys["report"] = stage_key("report", keys["ingest"], keys["render"], keys["measure"], keys["infer"])
+
+        graph = {
+            "ingest": ((), lambda: ingest_scan(nifti_path)),
+            "load": (("ingest",), lambda header: load_center_slices(nifti_path, header)),
+            "segment": (("load", "ingest"), lambda slices, header: segment_slices(
+                slices, header["intensity"]
+            )),
+            "measure": (("ingest",), compute_measurements),
+            "render": (("load", "segment", "ingest"), lambda slices, masks, header: render_slices(
+                slices, masks, header["intensity"]
+            )),
+            "infer": (("measure",), lambda measurements: run_ai_analysis(
+                patient_age=patient.get("age"),
+                patient_sex=patient.get("sex"),
+                patient_notes=patient.get("notes"),
+            )),
+            "report": (("ingest", "render", "measure", "infer"), build_report),
+        }
+        return {stage: (keys[stage], deps, fn) for stage, (deps, fn) in graph.items()}
+
+    def stage(self, nifti_path: str, study_id: str, stage: str, allow: dict = None):
+        """
+        Resolve a single patient-independent stage (e.g. "ingest" for the
+        study's header and intensity statistics), from cache when possible.
+        ``allow`` is as for run().
+        """
+        graph = self._graph(nifti_path, study_id, {})
+        value, _ = self._resolve(graph, stage, allow)
+        return value
+
+    def plan(self, nifti_path: str, study_id: str, patient: dict):
+        """List the stages that would execute (cache misses) for a request."""
+        graph = self._graph(nifti_path, study_id, patient)
+        to_run = []
+
+        def visit(stage):
+            key, deps, _ = graph[stage]
+            if stage in to_run or self.cache.has(stage, key):
+                return
+            for dep in deps:
+                visit(dep)
+            to_run.append(stage)
+
+        visit("report")
+        return to_run
+
+    def run(self, nifti_path: str, study_id: str, patient: dict, allow: dict = None):
+        """
+        Resolve the report stage, running only stages that miss the cache.
+
+        ``allow`` maps stage names to False to forbid computing them (e.g.
+        {"load": False} outside admission control); such a stage missing
+        the cache raises StageNotAllowed before anything is loaded.
+
+        Returns:
+            tuple: (report, trace) where trace lists every stage with its
+            key, whether it hit the cache, ran, or was not needed, and its
+            run time
+        """
+        graph = self._graph(nifti_path, study_id, patient)
+        report, trace = self._resolve(graph, "report", allow)
+        return report, [trace[stage] for stage in STAGE_VERSIONS]
+
+    def _resolve(self, graph: dict, target: str, allow: dict = None):
+        """Resolve ``target`` through the graph; returns (value, trace by stage)."""
+        trace = {stage: {"stage": stage, "key": key[:12], "status": "skipped", "elapsed_ms": 0.0}
+                 for stage, (key, _, _) in graph.items()}
+        resolved = {}
+
+        def resolve(stage):
+            if stage in resolved:
+                return resolved[stage]
+            key, deps, fn = graph[stage]
+
+            hit, value = self.cache.get(stage, key)
+            if hit:
+                trace[stage]["status"] = "cache_hit"
+            else:
+                if allow and not allow.get(stage, True):
+                    raise StageNotAllowed(stage)
+                inputs = [resolve(dep) for dep in deps]
+                start = time.time()
+                value = fn(*inputs)
+                trace[stage]["status"] = "computed"
+                trace[stage]["elapsed_ms"] = round((time.time() - start) * 1000, 1)
+                self.cache.put(stage, key, value)
+
+            resolved[stage] = value
+            return value
+
+        return resolve(target), trace
+
+def ingest_scan(nifti_path: str):
+    """
+    Header plus the global intensity statistics: a single streaming pass
+    the first time, then the statistics saved next to the upload.
+    """
+    header = read_header(nifti_path)
+    stats = load_intensity(nifti_path)
+    if stats is None:
+        stats = scan_intensity(nifti_path)
+        save_intensity(nifti_path, stats)
+    header["intensity"] = stats
+    return header
+
+def build_report(header: dict, rendered: dict, measurements: dict, ai_output: tuple):
+    """Assemble the imaging and AI outputs into the response payload."""
+    meta, resolution, sliders = describe_scan(header)
+    ai_summary, diseases, label_stats, preview3d = ai_output
+
+    return {
+        "scan_metadata": meta,
+        "resolution": resolution,
+        "measurements": measurements,
+        "slices": rendered["slices"],
+        "masks": rendered["masks"],
+        "sliders": sliders,
+        "intensity": summarize_intensity(header["intensity"]),
+        "ai_analysis": {
+            "finding": ai_summary["label"],
+            "confidence_score": f"{int(ai_summary['confidence'] * 100)}%",
+            "explanation": ai_summary["explanation"],
+            "diseases": diseases,
+            "label_stats": label_stats,
+        },
+    }
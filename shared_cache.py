@@ -0,0 +1,155 @@
+"""
+shared_cache.py
+========================================
+Filesystem Cache Shared Across Worker Processes
+Atomic writes, per-namespace LRU pruning by access time
+========================================
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get(
+    "CARDIO_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
+))
+CACHE_MAX_ENTRIES = int(os.environ.get("CARDIO_CACHE_MAX_ENTRIES", "512"))
+
+def atomic_write(path, data: bytes):
+    """
+    Write ``data`` to a temporary file beside ``path`` and rename it into
+    place, so readers in other processes never see a partial file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+class SharedCache:
+    """
+    Pickled values stored as one file per key under ``root/<namespace>/``.
+
+    Writes go to a temporary file and are renamed into place, so a reader
+    in another worker sees either nothing or a complete entry. Reads touch
+    the file's mtime, and each namespace is pruned oldest-first once it
+    holds more than ``max_entries`` files.
+
+    Clearing the whole cache writes a new generation token, which workers
+    compare against to know when to drop their own in-memory caches.
+    """
+
+    def __init__(self, root: Path = CACHE_DIR, max_entries: int = CACHE_MAX_ENTRIES):
+        self.root = Path(root)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _path(self, namespace: str, key: str) -> Path:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self.root / namespace / f"{digest}.pkl"
+
+    def has(self, namespace: str, key: str) -> bool:
+        return self._path(namespace, key).exists()
+
+    def get(self, namespace: str, key: str):
+        """Return (hit, value)."""
+        path = self._path(namespace, key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # Pruned mid-read or otherwise unusable: treat as a miss
+            return False, None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, value
+
+    def put(self, namespace: str, key: str, value):
+        path = self._path(namespace, key)
+        atomic_write(path, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self._prune(path.parent)
+
+    def delete(self, namespace: str, key: str):
+        try:
+            os.unlink(self._path(namespace, key))
+        except FileNotFoundError:
+            pass
+
+    def values(self, namespace: str) -> list:
+        """Every readable value in a namespace (unordered)."""
+        values = []
+        try:
+            entries = list(os.scandir(self.root / namespace))
+        except FileNotFoundError:
+            return values
+        for entry in entries:
+            if not entry.name.endswith(".pkl"):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    values.append(pickle.load(f))
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+        return values
+
+    def _prune(self, directory: Path):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".pkl"):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+            if len(entries) <= self.max_entries:
+                return
+
+            entries.sort()
+            for _, stale in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self, namespace: str = None):
+        """Remove one namespace, or every cached entry (starting a new generation)."""
+        target = self.root / namespace if namespace else self.root
+        shutil.rmtree(target, ignore_errors=True)
+        if namespace is None:
+            self._write_generation(uuid.uuid4().hex)
+
+    def generation(self):
+        """Token of the current cache generation (None before the first clear)."""
+        try:
+            return (self.root / "GENERATION").read_text().strip() or None
+        except OSError:
+            return None
+
+    def _write_generation(self, token: str):
+        atomic_write(self.root / "GENERATION", token.encode("utf-8"))
+
+_default = None
+
+def get_shared_cache() -> SharedCache:
+    """Process-wide cache rooted at CARDIO_CACHE_DIR."""
+    global _default
+    if _default is None:
+        _default = SharedCache()
+    return _default